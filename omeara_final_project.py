@@ -22,13 +22,19 @@ Finally, it prints the top 10 tracks in order for the given date and allows a us
 to enter a number to pull up the full Billboard list for more information.
 
 Data are cached in a json file, with summary data and track info saved in a SQLite
-database.
+database. Both are safe to share between several processes or threads running at once:
+cache entries are merged into the json file under a file lock and written atomically,
+and the database runs in WAL mode with one connection per thread.
 '''
 ## references:  Code influenced by/borrowed from github
 ##              users ZiqiLii and plamare/spotipy
 ######################################################
 
 import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
 import requests
 import webbrowser
 import sqlite3
@@ -39,6 +45,13 @@ import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 import secrets
 
+try:
+    import fcntl
+except ImportError:
+    # fcntl is not available on Windows; cache writes are then only coordinated
+    # between threads of the same process
+    fcntl = None
+
 cid = secrets.SPOTIPY_CLIENT_ID
 c_secret = secrets.SPOTIPY_CLIENT_SECRET
 
@@ -66,29 +79,71 @@ month_dict = {
 ########################
 
 CACHE_FILENAME = "billboard_cache.json"
+CACHE_LOCKFILE = CACHE_FILENAME + ".lock"
+
+cache_thread_lock = threading.Lock()
+
+# the umask can only be read by setting it, so look it up once at import time and
+# use it for the mode of a newly created cache file
+process_umask = os.umask(0)
+os.umask(process_umask)
+NEW_CACHE_FILE_MODE = 0o666 & ~process_umask
+
+# (inode, size, mtime) of the cache file as this process last read or wrote it
+cache_file_seen = None
 
-def open_cache():
+@contextmanager
+def cache_lock():
+    ''' holds an exclusive lock on the cache for the duration of a with block,
+    so that only one thread or process at a time can read-modify-write the cache file
+    Parameters
+    ----------
+    None
+    Returns
+    -------
+    None
+    '''
+    with cache_thread_lock:
+        with open(CACHE_LOCKFILE, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def open_cache(strict=False):
     ''' opens the cache file if it exists and loads the JSON into
     a dictionary, which it then returns.
     if the cache file doesn't exist, creates a new cache dictionary
     Parameters
     ----------
-    None
+    strict: bool
+        If False, any error reading the cache gives a new cache dictionary.
+        If True, only a missing cache file does; other errors are raised, so that
+        an unreadable cache is never overwritten with an empty one
     Returns
     -------
     The opened cache
     '''
     try:
-        cache_file = open(CACHE_FILENAME, 'r')
-        cache_contents = cache_file.read()
+        with open(CACHE_FILENAME, 'r') as cache_file:
+            cache_contents = cache_file.read()
         cache_dict = json.loads(cache_contents)
-        cache_file.close()
+    except FileNotFoundError:
+        cache_dict = {}
     except:
+        if strict:
+            raise
         cache_dict = {}
     return cache_dict
 
 def save_cache(cache_dict):
     ''' saves the current state of the cache to disk
+    The json is written to a temporary file that then replaces the cache file,
+    so readers never see a partially written cache. The new file keeps the mode of
+    the old one, so other users that could read the cache still can
     Parameters
     ----------
     cache_dict: dict
@@ -98,9 +153,69 @@ def save_cache(cache_dict):
     None
     '''
     dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
-    fw.write(dumped_json_cache)
-    fw.close()
+    cache_dir = os.path.dirname(os.path.abspath(CACHE_FILENAME))
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fw:
+            fw.write(dumped_json_cache)
+            fw.flush()
+            os.fsync(fw.fileno())
+        try:
+            cache_mode = os.stat(CACHE_FILENAME).st_mode & 0o777
+        except FileNotFoundError:
+            cache_mode = NEW_CACHE_FILE_MODE
+        os.chmod(temp_path, cache_mode)
+        os.replace(temp_path, CACHE_FILENAME)
+    except:
+        os.remove(temp_path)
+        raise
+
+def cache_file_signature():
+    ''' identifies the current version of the cache file on disk
+    Every save replaces the file with a new one, so a matching signature means
+    nobody has written the cache since it was taken
+    Parameters
+    ----------
+    None
+    Returns
+    -------
+    signature: tuple or None
+        The inode, size and modification time of the cache file,
+        None if the file doesn't exist
+    '''
+    try:
+        file_stat = os.stat(CACHE_FILENAME)
+    except FileNotFoundError:
+        return None
+    return (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+def update_cache(key, value):
+    ''' adds a single entry to the cache
+    The entry is merged into the cache file under the cache lock, so entries written
+    by other processes in the meantime are kept. The file is only re-read if it has
+    changed since this process last read or wrote it; otherwise the in-memory cache
+    is already up to date. The in-memory cache is refreshed with everything on disk.
+    Parameters
+    ----------
+    key: str
+        The cache key
+    value:
+        The json-serializable data to store under the key
+    Returns
+    -------
+    None
+    '''
+    global cache_file_seen
+    with cache_lock():
+        signature = cache_file_signature()
+        if signature is not None and signature == cache_file_seen:
+            cache_dict = dict(BILLBOARD_CACHE)
+        else:
+            cache_dict = open_cache(strict=True)
+        cache_dict[key] = value
+        save_cache(cache_dict)
+        cache_file_seen = cache_file_signature()
+        BILLBOARD_CACHE.update(cache_dict)
 
 BILLBOARD_CACHE = open_cache()
 
@@ -108,12 +223,54 @@ BILLBOARD_CACHE = open_cache()
 ## Setting up SQL Database Structure ##
 #######################################
 
-conn = sqlite3.connect('Spotify_Database.sqlite')
-cur = conn.cursor()
+DB_FILENAME = 'Spotify_Database.sqlite'
 
-drop_songs = '''
-    DROP TABLE IF EXISTS "Songs";
-'''
+db_local = threading.local()
+
+def get_connection():
+    ''' returns the SQLite connection for the calling thread, opening it on first use
+    Connections are not shared between threads. Each one runs in WAL mode, so readers
+    don't block the writer, and waits up to 30 seconds for other writers to finish.
+    Parameters
+    ----------
+    None
+    Returns
+    -------
+    conn: sqlite3.Connection
+        The connection for the current thread
+    '''
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILENAME, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        db_local.conn = conn
+    return conn
+
+@contextmanager
+def write_transaction():
+    ''' runs the statements of a with block as one write transaction
+    BEGIN IMMEDIATE takes the database write lock up front, so checks made inside the
+    block still hold when the writes happen. Commits on success, rolls back on error.
+    Parameters
+    ----------
+    None
+    Returns
+    -------
+    cur: sqlite3.Cursor
+        A cursor on the current thread's connection
+    '''
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        yield cur
+        cur.execute('COMMIT')
+    except BaseException:
+        # SQLite may already have rolled back by itself (e.g. on a full disk);
+        # a second ROLLBACK would fail and hide the original error
+        if conn.in_transaction:
+            cur.execute('ROLLBACK')
+        raise
 
 create_songs = '''
     CREATE TABLE IF NOT EXISTS "Songs" (
@@ -129,13 +286,6 @@ create_songs = '''
     );
 '''
 
-cur.execute(drop_songs)
-cur.execute(create_songs)
-
-drop_billboard = '''
-    DROP TABLE IF EXISTS "Billboard";
-'''
-
 create_billboard = '''
     CREATE TABLE IF NOT EXISTS "Billboard" (
         "Id"        INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
@@ -158,10 +308,54 @@ create_billboard = '''
     );
 '''
 
-cur.execute(drop_billboard)
-cur.execute(create_billboard)
+def create_tables():
+    ''' creates the database tables if they are missing
+    Tables are never dropped, so that starting another process doesn't wipe out rows
+    that running processes are writing. The connection used is closed afterwards, so
+    no connection is open when the module is imported and worker processes are forked.
+    Parameters
+    ----------
+    None
+    Returns
+    -------
+    None
+    '''
+    try:
+        with write_transaction() as cur:
+            cur.execute(create_songs)
+            cur.execute(create_billboard)
+    finally:
+        get_connection().close()
+        del db_local.conn
+
+create_tables()
+
+# objects inherited from the parent across fork() that the child must not use
+forked_connections = []
+
+def reset_after_fork():
+    ''' gives a forked child process its own locks and connections
+    A cache lock held by another thread at fork time would stay held forever in the
+    child, and a SQLite connection must not be used in a process other than the one
+    that opened it. The inherited connection is kept referenced so that it isn't
+    closed in the child either.
+    Parameters
+    ----------
+    None
+    Returns
+    -------
+    None
+    '''
+    global cache_thread_lock, db_local
+    inherited_conn = getattr(db_local, 'conn', None)
+    if inherited_conn is not None:
+        forked_connections.append(inherited_conn)
+    cache_thread_lock = threading.Lock()
+    db_local = threading.local()
 
-conn.commit()
+# os.register_at_fork is not available on Windows, which doesn't fork
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
 
 #######################################################################
 ## Setting up Song Class that Structures Data for Export and Display ##
@@ -231,22 +425,21 @@ class Song:
         '''
         Checks whether a song is in the database already and, if not, adds it
         '''
-        query = f'''
+        query = '''
         SELECT COUNT(DISTINCT TrackTitle)
         FROM [Songs]
-        WHERE TrackTitle = "{self.title}" AND Artist = "{self.artist}"
+        WHERE TrackTitle = ? AND Artist = ?
+        '''
+        insert_song = '''
+            INSERT INTO "Songs" 
+            ("TrackTitle", "Artist", "Album", "Acoustic", "Dance", "Energy", "Loud", "Valence") 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
         '''
-        result = cur.execute(query).fetchall()
-        if result[0][0] == 0:
-            insert_song = f'''
-                INSERT INTO "Songs" 
-                ("TrackTitle", "Artist", "Album", "Acoustic", "Dance", "Energy", "Loud", "Valence") 
-                VALUES ("{self.title}", "{self.artist}", "{self.album}", "{self.acousticness}", 
-                "{self.danceability}", "{self.energy}", "{self.loudness}", "{self.valence}"
-                );
-            '''
-            cur.execute(insert_song)
-        conn.commit()
+        with write_transaction() as cur:
+            result = cur.execute(query, (self.title, self.artist)).fetchall()
+            if result[0][0] == 0:
+                cur.execute(insert_song, (self.title, self.artist, self.album, self.acousticness,
+                    self.danceability, self.energy, self.loudness, self.valence))
 
 
 #########################################
@@ -369,8 +562,7 @@ def get_prev_hot100(date):
             }
             hot100_chart['songs'].append(song_dict)
             rank += 1
-        BILLBOARD_CACHE[date] = hot100_chart
-        save_cache(BILLBOARD_CACHE)
+        update_cache(date, hot100_chart)
         return BILLBOARD_CACHE[date]
 
 ######################################
@@ -444,8 +636,7 @@ def spotify_search(query):
         print('using cache')
     else:
         print('scraping data')
-        BILLBOARD_CACHE[query] = sp.search(q=query)
-        save_cache(BILLBOARD_CACHE)
+        update_cache(query, sp.search(q=query))
     raw_results = BILLBOARD_CACHE[query]
     song_id = raw_results['tracks']['items'][0]['id']
     title = raw_results['tracks']['items'][0]['name']